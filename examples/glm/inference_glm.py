@@ -7,7 +7,7 @@
 '''
 
 # here put the import lib
-from functools import partial
+from functools import lru_cache, partial
 import os
 import sys
 import random
@@ -25,25 +25,39 @@ from sat.arguments import initialize_distributed, set_random_seed
 
 from sat.model import GLMModel
 from sat.model.mixins import CachedAutoregressiveMixin
-from sat.generation.autoregressive_sampling import filling_sequence, evaluate_perplexity
+from sat.generation.autoregressive_sampling import filling_sequence, stream_filling_sequence, evaluate_perplexity
 from sat.generation.sampling_strategies import BeamSearchStrategy, BaseStrategy
 from sat.generation.utils import timed_name, generate_continually
 
 
-def get_masks_and_position_ids_glm(seq, mask_position, context_length):
+@lru_cache(maxsize=8)
+def _glm_attention_mask(seq_len, context_length, device, start_index=0):
+    # boolean mask, built directly on device; the attention op materializes
+    # the additive form lazily, so no fp32 allocation or fp16 cast is needed.
+    # memoized per shape: micro-batches and repeated queries of the same
+    # length reuse the cached tensor (it is only ever read downstream).
+    # rows for the first start_index (already cached) positions are skipped,
+    # and one broadcast comparison writes the causal pattern in one kernel.
+    cols = torch.arange(seq_len, device=device)
+    rows = torch.arange(start_index, seq_len, device=device)
+    attention_mask = cols <= rows[:, None]
+    attention_mask[..., :context_length] = True
+    return attention_mask[None, None]
+
+
+def get_masks_and_position_ids_glm(seq, mask_position, context_length, start_index=0):
     tokens = seq.unsqueeze(0)
 
-    attention_mask = torch.ones((1, len(seq), len(seq)), device=tokens.device)
-    attention_mask.tril_()
-    attention_mask[..., :context_length] = 1
-    attention_mask.unsqueeze_(1)
+    attention_mask = _glm_attention_mask(len(seq), context_length, tokens.device, start_index)
 
-    position_ids = torch.zeros(2, len(seq), device=tokens.device, dtype=torch.long)
-    torch.arange(0, context_length, out=position_ids[0, :context_length])
-    position_ids[0, context_length:] = mask_position
-    torch.arange(1, len(seq) - context_length + 1, out=position_ids[1, context_length:])
+    # build the tiny position tensor on the host (plain memory writes) and
+    # ship it with a single copy, instead of four device kernel launches
+    position_ids = torch.zeros(1, 2, len(seq), dtype=torch.long)
+    torch.arange(0, context_length, out=position_ids[0, 0, :context_length])
+    position_ids[0, 0, context_length:] = mask_position
+    torch.arange(1, len(seq) - context_length + 1, out=position_ids[0, 1, context_length:])
 
-    position_ids = position_ids.unsqueeze(0)
+    position_ids = position_ids.to(tokens.device, non_blocking=True)
     return tokens, attention_mask, position_ids
 
 
@@ -54,16 +68,42 @@ def main(model, args):
     model = model.to(args.device)
     set_random_seed(args.seed)
     model.eval()
+    # cache the compute dtype so per-call code does not walk the parameter list
+    model._compute_dtype = next(model.parameters()).dtype
+    # replay the decode forward through the static-shape CUDA Graph path of
+    # filling_sequence (see use_cuda_graph below); torch.compile's
+    # reduce-overhead mode recompiles on the growing per-step shapes instead
+    use_cuda_graph = not getattr(args, 'eager', False)
 
     end_tokens = [tokenizer.get_command('eop').Id, tokenizer.get_command('eos').Id]
-    # define function for each query
-    if args.sampling_strategy == 'BaseStrategy':
-        strategy = BaseStrategy(temperature=args.temperature, top_k=args.top_k,end_tokens=end_tokens)
-    elif args.sampling_strategy == 'BeamSearchStrategy':
-        strategy = BeamSearchStrategy(args.batch_size, length_penalty=args.length_penalty, consider_end=True, end_tokens=end_tokens, no_repeat_ngram_size=args.no_repeat_ngram_size, min_tgt_length=args.min_tgt_length)
-    else:
-        raise ValueError(f'unknown strategy {args.sampling_strategy}')
-    
+    # resolve command ids once: re-querying the tokenizer and rescanning the
+    # sequence several times per generation cycle is pure hot-path overhead
+    enc_id = tokenizer.get_command('ENC').Id
+    eos_id = tokenizer.get_command('eos').Id
+    sop_id = tokenizer.get_command('sop').Id
+    mask_ids = tuple(tokenizer.get_command(token).Id
+                     for token in (('MASK', 'sMASK', 'gMASK') if args.task_mask else ('MASK',)))
+    # define function for each query; strategies are stateful, so concurrent
+    # micro-batches each need their own instance
+    def make_strategy():
+        if args.sampling_strategy == 'BaseStrategy':
+            return BaseStrategy(temperature=args.temperature, top_k=args.top_k,end_tokens=end_tokens)
+        elif args.sampling_strategy == 'BeamSearchStrategy':
+            return BeamSearchStrategy(args.batch_size, length_penalty=args.length_penalty, consider_end=True, end_tokens=end_tokens, no_repeat_ngram_size=args.no_repeat_ngram_size, min_tgt_length=args.min_tgt_length)
+        else:
+            raise ValueError(f'unknown strategy {args.sampling_strategy}')
+    strategy = make_strategy()
+
+    # staging buffer on pinned memory, filled once per query and copied to the
+    # device asynchronously, instead of building a python-list cuda tensor per
+    # micro-batch (which allocates and blocks the stream)
+    input_buf = torch.full((args.out_seq_length,), -1, dtype=torch.long,
+                           pin_memory=torch.cuda.is_available())
+    # persistent device-side input and the mask ids for on-device detection:
+    # intermediate outputs never leave the device between generation cycles
+    input_dev = torch.full((args.out_seq_length,), -1, dtype=torch.long, device=args.device)
+    mask_ids_dev = torch.tensor(mask_ids, dtype=torch.long, device=args.device)
+
     def process(raw_text):
         if args.with_id:
             query_id, raw_text = raw_text.split('\t')
@@ -72,9 +112,9 @@ def main(model, args):
         if 'MASK]' not in raw_text:
             raw_text += ' ' + generation_mask
         seq = tokenizer.EncodeAsIds(raw_text).tokenization
-        seq = [tokenizer.get_command('ENC').Id] + seq
+        seq = [enc_id] + seq
         if not raw_text.endswith('MASK]'):
-            seq = seq + [tokenizer.get_command('eos').Id]
+            seq = seq + [eos_id]
         print('raw text: {}\n'.format(raw_text))
         if len(seq) > args.max_sequence_length:
             raise ValueError('text too long.')
@@ -86,50 +126,91 @@ def main(model, args):
         # continually detect the first mark position
         while True:
             seq = output_list[0] # TODO find the best one
-            # detect
-            mask_tokens = ['MASK', 'sMASK', 'gMASK'] if args.task_mask else ['MASK']
-            mask_tokens = [tokenizer.get_command(token).Id for token in mask_tokens]
-            mask_position = len(seq)
-            for token in mask_tokens:
-                try:
-                    mask_position = min(mask_position, seq.index(token))
-                except ValueError:
-                    pass
+            # detect the first mask position with a single pass
+            if isinstance(seq, torch.Tensor): # later cycles: still on device
+                hits = (seq.unsqueeze(-1) == mask_ids_dev).any(-1).nonzero(as_tuple=True)[0]
+                mask_position = int(hits[0]) if len(hits) > 0 else len(seq)
+            else: # first cycle: the tokenized query is a python list
+                mask_position = next((i for i, token in enumerate(seq) if token in mask_ids), len(seq))
             if mask_position == len(seq):
                 break
             
             get_func = partial(get_masks_and_position_ids_glm, mask_position=mask_position, context_length=len(seq))
+            # the input is identical (and read-only) across micro-batches:
+            # stage it once and reuse the persistent device tensor
+            if isinstance(seq, torch.Tensor):
+                input_dev[:len(seq)].copy_(seq)
+            else:
+                input_buf[:len(seq)] = torch.tensor(seq, dtype=torch.long)
+                input_dev[:len(seq)].copy_(input_buf[:len(seq)], non_blocking=True)
+            input_dev[len(seq)] = sop_id
+            input_dev[len(seq) + 1:] = -1
+            input_seq = input_dev
             output_list = []
-            for tim in range(max(args.batch_size // mbz, 1)):
-                input_seq = torch.cuda.LongTensor(
-                    seq + [tokenizer.get_command('sop').Id] + [-1] * (args.out_seq_length - len(seq) - 1),
-                    device=args.device)
+            num_shards = max(args.batch_size // mbz, 1)
+            if num_shards == 1:
                 output = filling_sequence(model, input_seq,
                         batch_size=min(args.batch_size, mbz),
                         strategy=strategy,
                         log_attention_weights=None,
-                        get_masks_and_position_ids=get_func
+                        get_masks_and_position_ids=get_func,
+                        use_cuda_graph=use_cuda_graph
                         )[0] # we don't use mems, fill back
                 if isinstance(output, torch.Tensor): # different strategies
                     output = list(output)
 
                 output_list.extend(output)
-
-            # clip -1s and fill back generated things into seq
+            else:
+                # mbz caps per-forward memory, and each shard holds live
+                # kv-cache buffers, so at most two shards run interleaved:
+                # one shard's python driver overlaps the other's kernels,
+                # and the next shard only starts once a running one retires
+                # (finalized immediately, releasing its buffers).
+                results = [None] * num_shards
+                active, next_shard = [], 0
+                while active or next_shard < num_shards:
+                    while len(active) < 2 and next_shard < num_shards:
+                        shard_strategy = make_strategy()
+                        filling_stream = stream_filling_sequence(model, input_seq,
+                                batch_size=mbz,
+                                strategy=shard_strategy,
+                                get_masks_and_position_ids=get_func
+                                )
+                        active.append([next_shard, shard_strategy, filling_stream, None])
+                        next_shard += 1
+                    for shard in list(active):
+                        try:
+                            shard[3] = next(shard[2]) # (tokens, logits, mems)
+                        except StopIteration:
+                            tokens, _, mems = shard[3]
+                            output = shard[1].finalize(tokens, mems)[0]
+                            if isinstance(output, torch.Tensor):
+                                output = list(output)
+                            results[shard[0]] = output
+                            active.remove(shard)
+                for output in results:
+                    output_list.extend(output)
+
+            # clip -1s and fill back generated things into seq, with tensor ops
+            # on device instead of O(seq_len) python .index() scans per sample
             for i in range(len(output_list)):
-                output = output_list[i].tolist()
-                try:
-                    unfinished = output.index(-1)
-                except ValueError:
-                    unfinished = len(output)
-                if output[unfinished - 1] in end_tokens:
+                output = output_list[i]
+                if not isinstance(output, torch.Tensor):
+                    output = torch.tensor(output, device=args.device)
+                pads = (output == -1).nonzero(as_tuple=True)[0]
+                unfinished = int(pads[0]) if len(pads) > 0 else len(output)
+                if int(output[unfinished - 1]) in end_tokens:
                     unfinished -= 1
-                bog = output.index(tokenizer.get_command('sop').Id)
-                output_list[i] = output[:mask_position] + output[bog + 1:unfinished] + output[mask_position + 1:bog]
+                bog = int((output == sop_id).nonzero(as_tuple=True)[0][0])
+                output_list[i] = torch.cat((
+                    output[:mask_position], output[bog + 1:unfinished], output[mask_position + 1:bog]
+                )) # stays on device until the final decode
 
-        # decoding
+        # decoding: the only host transfer of the finished sequences
         txts = []
         for seq in output_list:
+            if isinstance(seq, torch.Tensor):
+                seq = seq.cpu().tolist()
             decode_tokens = tokenizer.DecodeIds(seq)
             txts.append(decode_tokens)
 
@@ -153,6 +234,7 @@ from sat.model.official import GLMModel
 if __name__ == "__main__":
     py_parser = argparse.ArgumentParser(add_help=False)
     py_parser.add_argument('--sampling-strategy', type=str, default='BaseStrategy', help='type name of sampling strategy')
+    py_parser.add_argument('--eager', action='store_true', help='disable CUDA Graph replay of the decode forward')
     GLMModel.add_model_specific_args(py_parser)
     known, args_list = py_parser.parse_known_args()
     args = get_args(args_list)
@@ -11,53 +11,144 @@ import os
 import sys
 import math
 import random
+import inspect
 import torch
 from .sampling_strategies import BaseStrategy
 from sat.helpers import print_rank0
 
-def get_masks_and_position_ids_default(seq):
+def get_masks_and_position_ids_default(seq, start_index=0):
+    '''start_index: the first start_index positions are already cached in
+    mems, so only mask rows for the remaining positions are built --
+    O(new_tokens x L) instead of O(L x L) for continuation calls.'''
     tokens = seq.unsqueeze(0)
 
-    attention_mask = torch.ones((1, len(seq), len(seq)), device=tokens.device)
-    attention_mask.tril_()
-    attention_mask.unsqueeze_(1)
+    # boolean mask: 8x smaller than fp32 and no bool->fp16 cast downstream;
+    # the attention op materializes the additive form lazily when needed.
+    # a single broadcast comparison writes the causal pattern in one kernel,
+    # instead of a full ones fill followed by a tril pass.
+    cols = torch.arange(len(seq), device=tokens.device)
+    rows = torch.arange(start_index, len(seq), device=tokens.device)
+    attention_mask = (cols <= rows[:, None])[None, None] # row r is absolute position start_index + r
 
     position_ids = torch.arange(len(seq), dtype=torch.long, device=tokens.device)
     position_ids = position_ids.unsqueeze(0)
     return tokens, attention_mask, position_ids
 
-def update_mems(hiddens, mems, max_memory_length):
+def update_mems(hiddens, mems_buf, valid_length, max_memory_length):
     '''
-        hiddens: list (num_layers) of [batch, query_length, 2d]
-        mems: None or [num_layers, batch, memory_length, 2d]
+        hiddens: None or list (num_layers) of [batch, query_length, 2d]
+        mems_buf: preallocated [num_layers, batch, capacity, 2d], whose first
+            valid_length rows hold the current cache.
+        Writes the new entries into mems_buf in place (evicting the oldest rows
+        when max_memory_length is reached) instead of torch.cat-ing the whole
+        history per step, and returns (mems, new_valid_length) where
+        mems = mems_buf[:, :, :new_valid_length] shares storage with mems_buf.
     '''
     if hiddens is None:
-        return None
-    hiddens = torch.stack(hiddens)
-    memory_length = mems.shape[2] if mems is not None else 0
-    query_length = hiddens.shape[2]
-    new_memory_length = min(max_memory_length, memory_length + query_length)
+        return None, valid_length
+    query_length = hiddens[0].shape[1]
+    new_memory_length = min(max_memory_length, valid_length + query_length)
     with torch.no_grad():
         if new_memory_length <= query_length:
-            return hiddens[:, :, -new_memory_length:]
-        else:
-            if mems.shape[1] < hiddens.shape[1]:
-                mems = mems.expand(-1, hiddens.shape[1], -1, -1)
-            return torch.cat(
-                (mems[:, :, -new_memory_length+query_length:], hiddens),
-                dim=2
+            valid_length = 0
+            if new_memory_length < query_length:
+                hiddens = [h[:, -new_memory_length:] for h in hiddens]
+        elif valid_length + query_length > new_memory_length:
+            shift = valid_length + query_length - new_memory_length
+            mems_buf[:, :, :valid_length - shift].copy_(
+                mems_buf[:, :, shift:valid_length].clone())
+            valid_length -= shift
+        for i, hidden in enumerate(hiddens):
+            mems_buf[i, :, valid_length:new_memory_length].copy_(hidden)
+    return mems_buf[:, :, :new_memory_length], new_memory_length
+
+
+# decode buffers are padded up to one of these lengths so a captured graph can
+# be replayed for every query that fits the same bucket
+GRAPH_LENGTH_BUCKETS = (128, 256, 512, 1024, 2048)
+
+
+class CudaGraphDecoder:
+    '''
+        Capture the steady-state single-token decode forward into a CUDA Graph,
+        then replay it every step instead of launching ~O(num_layers) kernels
+        from python. All inputs live in persistent buffers with static shapes:
+        the cache buffer is preallocated at full capacity and invalid slots are
+        masked out, so the replayed kernels never change shape.
+        Sampling strategies stay eager because they synchronize with the host
+        (multinomial + .item()), which is not capturable.
+    '''
+    num_warmup_steps = 3 # eager decode steps before capture, to stabilize autotuning
+
+    def __init__(self, model, input_ids, position_ids, attention_mask, mems, capacity, mems_cross=None, **kw_args):
+        # persistent input buffers, written with copy_ before every replay
+        self.capacity = capacity
+        self.input_buf = input_ids.clone()
+        self.position_buf = position_ids.clone()
+        self.mask_buf = torch.zeros(
+            (1, 1, 1, capacity + 1), dtype=attention_mask.dtype, device=input_ids.device)
+        self.valid = mems.shape[2]
+        self.mask_buf[..., :self.valid] = 1
+        self.mask_buf[..., capacity] = 1 # the current token always attends to itself
+        self._marked = self.valid
+        self.mems_buf = torch.zeros(
+            (mems.shape[0], input_ids.shape[0], capacity, mems.shape[3]),
+            dtype=mems.dtype, device=mems.device)
+        self.mems_buf[:, :, :self.valid].copy_(mems)
+        # tensor write position lets the captured index_copy_ land the new kv
+        # rows in a different slot on every replay
+        self.write_pos = torch.tensor([self.valid], dtype=torch.long, device=mems.device)
+        # capture; results of the capture pass are garbage, the caller must
+        # call step() (which replays) to compute the pending step for real.
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            logits, *output_per_layers = model(
+                input_ids=self.input_buf,
+                position_ids=self.position_buf,
+                attention_mask=self.mask_buf,
+                mems=self.mems_buf,
+                mems_cross=mems_cross,
+                log_attention_weights=None,
+                mems_buf=self.mems_buf,
+                mems_write_pos=self.write_pos,
+                **kw_args
             )
+        self.logits = logits
+
+    def reset(self, mems):
+        '''Rearm a cached decoder for a new generation with the same shapes.'''
+        self.valid = mems.shape[2]
+        self.mems_buf[:, :, :self.valid].copy_(mems)
+        self.mask_buf[..., :self.capacity] = 0
+        self.mask_buf[..., :self.valid] = 1
+        self._marked = self.valid
+
+    def step(self, input_ids, position_ids, mems):
+        '''Run one decode forward by replaying the captured graph.'''
+        if mems.data_ptr() != self.mems_buf.data_ptr():
+            # the strategy reordered the cache (e.g. beam search), sync it back
+            self.mems_buf[:, :, :self.valid].copy_(mems)
+        self.input_buf.copy_(input_ids)
+        self.position_buf.copy_(position_ids)
+        if self.valid > self._marked:
+            self.mask_buf[..., self._marked:self.valid] = 1
+            self._marked = self.valid
+        self.write_pos.fill_(self.valid)
+        self.graph.replay()
+        self.valid += 1
+        return self.logits, self.mems_buf[:, :, :self.valid]
 
 
 def filling_sequence(
-        model, 
-        seq, 
+        model,
+        seq,
         batch_size,
         strategy=BaseStrategy(),
         max_memory_length=100000,
         log_attention_weights=None,
         get_masks_and_position_ids=get_masks_and_position_ids_default,
         mems=None,
+        use_cuda_graph=False,
         **kw_args
         ):
     '''
@@ -66,6 +157,9 @@ def filling_sequence(
             cache, should be first mems.shape[1] parts of context_tokens.
             mems are the first-level citizens here, but we don't assume what is memorized.
             input mems are used when multi-phase generation.
+        use_cuda_graph: capture the steady-state decode forward into a CUDA
+            Graph and replay it per token. Requires cuda and no teacher-forced
+            tokens after the context; falls back to eager otherwise.
     '''
     assert len(seq.shape) == 1
     if hasattr(strategy, 'num_beams') and batch_size < strategy.num_beams:
@@ -77,54 +171,152 @@ def filling_sequence(
     while seq[context_length] >= 0:
         context_length += 1 # [0, context_length-1] are given
     assert context_length > 0
-    tokens, attention_mask, position_ids = get_masks_and_position_ids(seq)
-    tokens = tokens[..., :context_length]
-    if attention_mask.dtype != torch.bool:
-        attention_mask = attention_mask.type_as(next(model.parameters())) # if fp16
+    # the first mems.shape[2] positions are already cached: helpers that take
+    # start_index only build mask rows for the remaining positions
+    start_index = 0 if mems is None else mems.shape[2]
+    mask_offset = 0
+    if start_index > 0:
+        try:
+            if 'start_index' in inspect.signature(get_masks_and_position_ids).parameters:
+                mask_offset = start_index
+        except (TypeError, ValueError): # builtins / exotic callables
+            pass
+    if mask_offset > 0:
+        tokens, attention_mask, position_ids = get_masks_and_position_ids(seq, start_index=start_index)
+    else:
+        tokens, attention_mask, position_ids = get_masks_and_position_ids(seq)
+    # preallocate the token buffer and write new tokens in place, instead of
+    # torch.cat-ing the whole history per generated token
+    tokens_buf = seq.new_full((batch_size, len(seq)), -1)
+    tokens_buf[:, :context_length] = tokens[..., :context_length]
+    tokens = tokens_buf[:1, :context_length]
     # initialize generation
-    counter = context_length - 1 # Last fixed index is ``counter'' 
-    index = 0 if mems is None else mems.shape[2] # Next forward starting index, also the length of cache.
+    counter = context_length - 1 # Last fixed index is ``counter''
+    index = start_index # Next forward starting index, also the length of cache.
     mems_cross = None
+    # the kv-cache buffer is allocated lazily (its layer/hidden dims are only
+    # known after the first forward) with room for the whole generation
+    mems_buf, mems_valid = None, index
+    mems_capacity = min(max_memory_length, len(seq))
+    # steady-state decode (query_length == 1) only needs a single all-visible
+    # mask row -- the new token attends to every cached position -- so keep one
+    # preallocated row instead of re-slicing the full [.., L, L] mask per step
+    decode_mask = torch.ones((1, 1, 1, len(seq)), dtype=attention_mask.dtype, device=seq.device)
+    # graph capture needs static shapes: cuda, no teacher-forced suffix, no
+    # eviction. The capacity is rounded up to a bucket so one captured graph
+    # serves every query of a similar length.
+    graph_capacity = next((b for b in GRAPH_LENGTH_BUCKETS if b >= len(seq)), len(seq))
+    use_cuda_graph = use_cuda_graph and seq.device.type == 'cuda' \
+        and log_attention_weights is None and max_memory_length >= graph_capacity \
+        and not bool((seq[context_length:] >= 0).any())
+    graph_decoder = None
+    eager_decode_steps = 0
+    mem_kv_scratch = None # reused per step instead of rebuilding a list of layer outputs
     # step-by-step generation
     while counter < len(seq) - 1:
         # Now, we want to generate seq[counter + 1],
         # token[:, index: counter+1] needs forwarding.
 
         if seq[counter + 1] >= 0: # provided
-            tokens = torch.cat(
-                (
-                tokens, 
-                    seq[counter+1: counter+2].expand(tokens.shape[0], 1)
-                ), dim=1
-            )
+            tokens_buf[:, counter + 1] = seq[counter + 1]
+            tokens = tokens_buf[:tokens.shape[0], :counter + 2]
             counter += 1
             continue
 
         # forward
-        if log_attention_weights is not None:
-            log_attention_weights_part = log_attention_weights[..., index: counter+1, :counter+1] # TODO memlen
+        if use_cuda_graph and graph_decoder is None and index == counter \
+                and tokens.shape[0] == batch_size and mems is not None \
+                and eager_decode_steps >= CudaGraphDecoder.num_warmup_steps:
+            try:
+                # captured graphs are cached on the model per bucket and reused
+                # across queries; kw_args / cross mems are baked into a capture,
+                # so only plain decoders are shared
+                cacheable = not kw_args and mems_cross is None
+                decoders = getattr(model, '_cuda_graph_decoders', None)
+                if decoders is None:
+                    decoders = model._cuda_graph_decoders = {}
+                key = (graph_capacity, batch_size, mems.shape[0], mems.shape[3],
+                       mems.dtype, attention_mask.dtype, tuple(position_ids.shape[:-1]))
+                graph_decoder = decoders.get(key) if cacheable else None
+                if graph_decoder is not None:
+                    graph_decoder.reset(mems)
+                else:
+                    graph_decoder = CudaGraphDecoder(
+                        model, tokens[:, index:], position_ids[..., index: counter+1],
+                        attention_mask, mems, graph_capacity, mems_cross=mems_cross, **kw_args)
+                    if cacheable:
+                        decoders[key] = graph_decoder
+            except Exception:
+                print_rank0('Failed to capture decode step into a CUDA Graph, fall back to eager.', level='DEBUG')
+                use_cuda_graph = False
+
+        if graph_decoder is not None:
+            logits, mems = graph_decoder.step(
+                tokens[:, index:], position_ids[..., index: counter+1], mems)
         else:
-            log_attention_weights_part = None
+            if log_attention_weights is not None:
+                log_attention_weights_part = log_attention_weights[..., index: counter+1, :counter+1] # TODO memlen
+            else:
+                log_attention_weights_part = None
 
-        logits, *output_per_layers = model(
-            input_ids=tokens[:, index:], 
-            position_ids=position_ids[..., index: counter+1],
-            attention_mask=attention_mask[..., index: counter+1, :counter+1], # TODO memlen
-            mems=mems,
-            mems_cross=mems_cross,
-            log_attention_weights=log_attention_weights_part,
-            **kw_args
-        )
-        if len(output_per_layers) > 0 and 'mem_cross' in output_per_layers[0]:
-            mems_cross = [mem['mem_cross'] for mem in output_per_layers]
-        mem_kv = [o['mem_kv'] for o in output_per_layers]
-        mems = update_mems(mem_kv, mems, max_memory_length=max_memory_length)
+            # once the buffer exists and no eviction is due, each layer writes
+            # its new kv rows into mems_buf inside the forward (no stack + cat)
+            query_length = counter + 1 - index
+            mem_write_kwargs = {}
+            if mems_buf is not None and mems_valid + query_length <= mems_capacity:
+                mem_write_kwargs = {'mems_buf': mems_buf, 'mems_write_pos': mems_valid}
+
+            logits, *output_per_layers = model(
+                input_ids=tokens[:, index:],
+                position_ids=position_ids[..., index: counter+1],
+                attention_mask=decode_mask[..., :counter+1] if index == counter
+                    else attention_mask[..., index - mask_offset: counter+1 - mask_offset, :counter+1], # TODO memlen
+                mems=mems,
+                mems_cross=mems_cross,
+                log_attention_weights=log_attention_weights_part,
+                **mem_write_kwargs,
+                **kw_args
+            )
+            if len(output_per_layers) > 0 and 'mem_cross' in output_per_layers[0]:
+                mems_cross = [mem['mem_cross'] for mem in output_per_layers]
+            if mem_write_kwargs and not (output_per_layers and 'mem_kv' in output_per_layers[0]):
+                mems_valid += query_length
+                mems = mems_buf[:, :, :mems_valid]
+            else: # first forward, eviction due, or a mixin that ignores mems_buf
+                if mem_kv_scratch is None:
+                    mem_kv_scratch = [None] * len(output_per_layers)
+                for i, o in enumerate(output_per_layers):
+                    mem_kv_scratch[i] = o.pop('mem_kv')
+                mem_kv = mem_kv_scratch
+                if mem_kv and mems_buf is None:
+                    mems_buf = torch.zeros(
+                        len(mem_kv), batch_size, mems_capacity, mem_kv[0].shape[-1],
+                        dtype=mem_kv[0].dtype, device=mem_kv[0].device)
+                    if mems is not None: # provided cache of multi-phase generation
+                        mems_buf[:, :, :mems_valid].copy_(mems)
+                mems, mems_valid = update_mems(mem_kv, mems_buf, mems_valid, max_memory_length=max_memory_length)
+                for i in range(len(mem_kv_scratch)):
+                    mem_kv_scratch[i] = None # let the kv tensors go a step sooner
+            if index == counter:
+                eager_decode_steps += 1
         counter += 1
         index = counter
         # sampling
-        logits = logits[:, -1].expand(batch_size, -1) # [batch size, vocab size]
-        tokens = tokens.expand(batch_size, -1)
+        logits = logits[:, -1] # [b, vocab size]; b==1 before the first strategy
+        # step -- strategies broadcast the single row instead of materializing
+        # an expanded [batch, vocab] copy here
+        if tokens.shape[0] != batch_size:
+            tokens = tokens.expand(batch_size, -1)
         tokens, mems = strategy.forward(logits, tokens, mems)
+        # strategies that rebuild tokens/mems (torch.cat, beam reordering)
+        # return fresh tensors; sync them back into the persistent buffers
+        if tokens.data_ptr() != tokens_buf.data_ptr():
+            tokens_buf[:tokens.shape[0], :tokens.shape[1]].copy_(tokens)
+            tokens = tokens_buf[:tokens.shape[0], :tokens.shape[1]]
+        if graph_decoder is None and mems_buf is not None and mems is not None \
+                and mems.data_ptr() != mems_buf.data_ptr():
+            mems_buf[:, :, :mems_valid].copy_(mems)
+            mems = mems_buf[:, :, :mems_valid]
         if strategy.is_done:
             break
     return strategy.finalize(tokens, mems)
@@ -170,25 +362,37 @@ def stream_filling_sequence(
     while seq[context_length] >= 0:
         context_length += 1 # [0, context_length-1] are given
     assert context_length > 0
-    tokens, attention_mask, position_ids = get_masks_and_position_ids(seq)
-    tokens = tokens[..., :context_length]
-    if attention_mask.dtype != torch.bool:
-        attention_mask = attention_mask.type_as(next(model.parameters())) # if fp16
+    start_index = 0 if mems is None else mems.shape[2]
+    mask_offset = 0
+    if start_index > 0:
+        try:
+            if 'start_index' in inspect.signature(get_masks_and_position_ids).parameters:
+                mask_offset = start_index
+        except (TypeError, ValueError):
+            pass
+    if mask_offset > 0:
+        tokens, attention_mask, position_ids = get_masks_and_position_ids(seq, start_index=start_index)
+    else:
+        tokens, attention_mask, position_ids = get_masks_and_position_ids(seq)
+    # preallocated buffers, written in place per step, see filling_sequence
+    tokens_buf = seq.new_full((batch_size, len(seq)), -1)
+    tokens_buf[:, :context_length] = tokens[..., :context_length]
+    tokens = tokens_buf[:1, :context_length]
     # initialize generation
-    counter = context_length - 1 # Last fixed index is ``counter'' 
-    index = 0 if mems is None else mems.shape[2] # Next forward starting index, also the length of cache.
+    counter = context_length - 1 # Last fixed index is ``counter''
+    index = start_index # Next forward starting index, also the length of cache.
+    mems_buf, mems_valid = None, index
+    mems_capacity = min(max_memory_length, len(seq))
+    decode_mask = torch.ones((1, 1, 1, len(seq)), dtype=attention_mask.dtype, device=seq.device)
+    mem_kv_scratch = None # reused per step instead of rebuilding a list of layer outputs
     # step-by-step generation
     while counter < len(seq) - 1:
         # Now, we want to generate seq[counter + 1],
         # token[:, index: counter+1] needs forwarding.
 
         if seq[counter + 1] >= 0: # provided
-            tokens = torch.cat(
-                (
-                tokens, 
-                    seq[counter+1: counter+2].expand(tokens.shape[0], 1)
-                ), dim=1
-            )
+            tokens_buf[:, counter + 1] = seq[counter + 1]
+            tokens = tokens_buf[:tokens.shape[0], :counter + 2]
             counter += 1
             continue
 
@@ -198,27 +402,59 @@ def stream_filling_sequence(
         else:
             log_attention_weights_part = None
 
+        query_length = counter + 1 - index
+        mem_write_kwargs = {}
+        if mems_buf is not None and mems_valid + query_length <= mems_capacity:
+            mem_write_kwargs = {'mems_buf': mems_buf, 'mems_write_pos': mems_valid}
+
         logits, *output_per_layers = model(
-            tokens[:, index:], 
+            tokens[:, index:],
             position_ids=position_ids[..., index: counter+1],
-            attention_mask=attention_mask[..., index: counter+1, :counter+1], # TODO memlen
+            attention_mask=decode_mask[..., :counter+1] if index == counter
+                else attention_mask[..., index - mask_offset: counter+1 - mask_offset, :counter+1], # TODO memlen
             mems=mems,
             log_attention_weights=log_attention_weights_part,
+            **mem_write_kwargs,
             **kw_args
         )
-        mem_kv = [o['mem_kv'] for o in output_per_layers]
-        mems = update_mems(mem_kv, mems, max_memory_length=max_memory_length)
-        
+        if mem_write_kwargs and not (output_per_layers and 'mem_kv' in output_per_layers[0]):
+            mems_valid += query_length
+            mems = mems_buf[:, :, :mems_valid]
+        else: # first forward, eviction due, or a mixin that ignores mems_buf
+            if mem_kv_scratch is None:
+                mem_kv_scratch = [None] * len(output_per_layers)
+            for i, o in enumerate(output_per_layers):
+                mem_kv_scratch[i] = o.pop('mem_kv')
+            mem_kv = mem_kv_scratch
+            if mem_kv and mems_buf is None:
+                mems_buf = torch.zeros(
+                    len(mem_kv), batch_size, mems_capacity, mem_kv[0].shape[-1],
+                    dtype=mem_kv[0].dtype, device=mem_kv[0].device)
+                if mems is not None: # provided cache of multi-phase generation
+                    mems_buf[:, :, :mems_valid].copy_(mems)
+            mems, mems_valid = update_mems(mem_kv, mems_buf, mems_valid, max_memory_length=max_memory_length)
+            for i in range(len(mem_kv_scratch)):
+                mem_kv_scratch[i] = None # let the kv tensors go a step sooner
+
         # sampling
-        logits = logits[:, -1].expand(batch_size, -1) # [batch size, vocab size]
-        tokens = tokens.expand(batch_size, -1)
+        logits = logits[:, -1] # [b, vocab size]; b==1 before the first strategy
+        # step -- strategies broadcast the single row instead of materializing
+        # an expanded [batch, vocab] copy here
+        if tokens.shape[0] != batch_size:
+            tokens = tokens.expand(batch_size, -1)
         tokens, mems = strategy.forward(logits, tokens, mems)
-        
-        yield tokens, logits, mems # tokens: after concating in strategy; logits: the last token; 
-        
+        if tokens.data_ptr() != tokens_buf.data_ptr():
+            tokens_buf[:tokens.shape[0], :tokens.shape[1]].copy_(tokens)
+            tokens = tokens_buf[:tokens.shape[0], :tokens.shape[1]]
+        if mems_buf is not None and mems is not None and mems.data_ptr() != mems_buf.data_ptr():
+            mems_buf[:, :, :mems_valid].copy_(mems)
+            mems = mems_buf[:, :, :mems_valid]
+
+        yield tokens, logits, mems # tokens: after concating in strategy; logits: the last token;
+
         counter += 1
         index = counter
-        
+
         if strategy.is_done:
             break
     # return strategy.finalize(tokens, mems)
@@ -239,17 +475,25 @@ def evaluate_perplexity(model, tokens, attention_mask, position_ids, loss_mask,
         tokens[pad_pos] = 0
         loss_mask[pad_pos] = 0
 
-    attention_mask = attention_mask.type_as(next(model.parameters()))
+    # prefer the dtype cached at setup over walking the parameter iterator
+    # on every call (see e.g. main() of the inference examples)
+    dtype = getattr(model, '_compute_dtype', None)
+    if dtype is None:
+        dtype = next(model.parameters()).dtype
+    attention_mask = attention_mask.to(dtype)
     logits = model(tokens, position_ids, attention_mask)[0]
     logits = logits.float()
     for slc in invalid_slices:
         logits[..., slc] = -float('Inf')
-    log_probs = torch.log(torch.nn.functional.softmax(logits, dim=-1))
-
-    pred = log_probs[:, :-1, :] 
-    target = tokens[:, 1:].unsqueeze(-1) 
+    # fused log-softmax + gather + negate in one kernel over [batch, seq, vocab],
+    # numerically stable (log-sum-exp) unlike torch.log(softmax(...)) + gather
+    batch_size, seq_len, vocab_size = logits.shape
     loss_mask = loss_mask[..., 1:]
-    scores = torch.gather(pred, dim=2, index=target).squeeze(-1) # [batch_size, seq_len-1]
+    scores = -torch.nn.functional.cross_entropy(
+        logits[:, :-1].reshape(-1, vocab_size),
+        tokens[:, 1:].reshape(-1),
+        reduction='none'
+    ).view(batch_size, seq_len - 1) # [batch_size, seq_len-1]
     if reduction == 'mean':
         return (scores * loss_mask).sum(dim=-1) / loss_mask.sum(dim=-1)
     elif reduction == 'none':
@@ -15,13 +15,25 @@ import torch
 import torch.nn.functional as F
 from sat.mpu.initialize import get_model_parallel_world_size, get_model_parallel_src_rank, get_model_parallel_group
 
+try:
+    from .triton_topk import batched_topk_values
+except ImportError: # triton not installed
+    batched_topk_values = None
+
 def top_k_logits(logits, top_k=0, top_p=0.0, filter_value=-65504):
     # This function has been mostly taken from huggingface conversational ai code at
     # https://medium.com/huggingface/how-to-build-a-state-of-the-art-conversational-ai-with-transfer-learning-2d818ac26313
 
     if top_k > 0:
         # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
+        if batched_topk_values is not None and logits.is_cuda and len(logits.shape) == 2 \
+                and logits.shape[-1] >= 8192 and top_k <= 1024:
+            # split-topk kernel: generic torch.topk is a poor fit for the
+            # small-k / large-vocab shape of per-step sampling
+            kth_value = batched_topk_values(logits, top_k)[..., -1, None]
+        else:
+            kth_value = torch.topk(logits, top_k)[0][..., -1, None]
+        indices_to_remove = logits < kth_value
         logits[indices_to_remove] = filter_value
 
     # if top_p > 0.0:
@@ -90,6 +102,10 @@ class BaseStrategy:
             logits[..., invalid_slice] = -65504
         logits = top_k_logits(logits, self.topk, self.top_p)
         probs = F.softmax(logits, dim=-1)  # float is essetial, due to a bug in Pytorch
+        if probs.shape[0] < tokens.shape[0]:
+            # first decode step: logits arrive as a single row, broadcast into
+            # the fresh batch as a view instead of materializing copies earlier
+            probs = probs.expand(tokens.shape[0], -1)
         pred = torch.multinomial(probs, num_samples=1)
         if get_model_parallel_world_size() > 1:
             torch.distributed.broadcast(pred, get_model_parallel_src_rank(), group=get_model_parallel_group())
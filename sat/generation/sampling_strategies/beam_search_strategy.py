@@ -100,15 +100,22 @@ class BeamSearchStrategy:
         # logits = logits / self.temperature
         logits = top_k_logits(logits, self.top_k, self.top_p)
 
+        if batch_size < tokens.shape[0]:
+            # first decode step: the logits arrive as one broadcastable row;
+            # expand as a view so the flattened candidate draw and its RNG
+            # consumption match the old [num_beams, vocab] contract exactly
+            batch_size = tokens.shape[0]
+            logits = logits.expand(batch_size, -1)
+
         next_token_scores = F.log_softmax(logits, dim=-1) # [batch_size, vocab_size]
         prev_scores = self.cached_beam_scores
         if isinstance(self.cached_beam_scores, torch.Tensor):
             prev_scores = prev_scores[:, None].expand_as(next_token_scores)
         next_token_scores = next_token_scores + prev_scores
-        
-        next_token_scores = next_token_scores.view(batch_size * vocab_size)
 
-        probs = F.softmax(logits.view(batch_size * vocab_size), dim=0)
+        next_token_scores = next_token_scores.reshape(batch_size * vocab_size)
+
+        probs = F.softmax(logits.reshape(batch_size * vocab_size), dim=0)
         next_tokens = torch.multinomial(probs, 
             num_samples=(max(1,len(self.end_tokens))+1) * self.num_beams) # [2*nb]
         if get_model_parallel_world_size() > 1:
@@ -0,0 +1,58 @@
+# -*- encoding: utf-8 -*-
+'''
+@File    :   triton_topk.py
+@Time    :   2026/09/01
+'''
+
+# here put the import lib
+import torch
+
+import triton
+import triton.language as tl
+
+
+@triton.jit
+def _part_topk_kernel(
+    X, OUT,
+    n_cols, part_size,
+    stride_x_row,
+    K: tl.constexpr,
+    BLOCK: tl.constexpr,
+):
+    # one program reduces one part of one row to its local top-K values by
+    # iterative argmax; the global top-K is a subset of the union of the
+    # per-part top-Ks, so a cheap second stage over the candidates is exact.
+    row = tl.program_id(0)
+    part = tl.program_id(1)
+    cols = part * part_size + tl.arange(0, BLOCK)
+    mask = (tl.arange(0, BLOCK) < part_size) & (cols < n_cols)
+    x = tl.load(X + row * stride_x_row + cols, mask=mask, other=-float('inf'))
+    out_base = OUT + (row * tl.num_programs(1) + part) * K
+    for i in range(K):
+        val = tl.max(x, axis=0)
+        idx = tl.argmax(x, axis=0)
+        tl.store(out_base + i, val)
+        # knock out a single occurrence so duplicated values stay rankable
+        x = tl.where(tl.arange(0, BLOCK) == idx, -float('inf'), x)
+
+
+def batched_topk_values(logits, k):
+    '''
+        logits: [batch, vocab_size] on cuda, k <= 1024.
+        Returns the top-k values per row, sorted descending, like
+        torch.topk(logits, k)[0]. Two-stage split reduction: vocab is cut
+        into ~part_size chunks reduced in parallel, then torch.topk runs
+        over only [batch, parts * k] candidates instead of the full vocab.
+    '''
+    batch, n_cols = logits.shape
+    logits = logits.contiguous()
+    part_size = max(triton.next_power_of_2(k), 1024)
+    parts = triton.cdiv(n_cols, part_size)
+    candidates = torch.empty(batch, parts * k, device=logits.device, dtype=logits.dtype)
+    _part_topk_kernel[(batch, parts)](
+        logits, candidates,
+        n_cols, part_size,
+        logits.stride(0),
+        K=k, BLOCK=part_size,
+    )
+    return torch.topk(candidates, k, dim=-1)[0]
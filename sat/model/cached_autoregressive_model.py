@@ -28,7 +28,17 @@ class CachedAutoregressiveMixin(BaseMixin):
             b, nh, seq_len, hidden_size = k.shape
 
             cache_kv = torch.stack((k, v)).permute(1, 3, 0, 2, 4).detach().contiguous().view(b, seq_len, nh * hidden_size * 2)
-            kw_args['output_this_layer']['mem_kv'] = cache_kv
+            mems_buf = kw_args.get('mems_buf', None)
+            if mems_buf is not None:
+                # write the new rows straight into the caller's preallocated
+                # cache buffer, skipping the per-step stack + cat of update_mems
+                write_pos = kw_args['mems_write_pos']
+                if isinstance(write_pos, torch.Tensor): # under CUDA Graph replay
+                    mems_buf[kw_args['layer_id']].index_copy_(1, write_pos, cache_kv)
+                else:
+                    mems_buf[kw_args['layer_id'], :, write_pos:write_pos + seq_len].copy_(cache_kv)
+            else:
+                kw_args['output_this_layer']['mem_kv'] = cache_kv
 
             if mem is not None: # the first time, mem is None
                 # might change batch_size
@@ -497,9 +497,12 @@ class BaseTransformer(torch.nn.Module):
             attention_mask = torch.ones(query_length, query_length, 
                                         device=input_ids.device).tril()
             
-        attention_mask = attention_mask.type_as(
-                next(self.parameters())
-            )
+        if attention_mask.dtype != torch.bool:
+            # boolean masks are consumed as-is (the attention op materializes
+            # the additive form lazily), skipping an L x L cast per call
+            attention_mask = attention_mask.type_as(
+                    next(self.parameters())
+                )
         assert len(attention_mask.shape) == 2 or \
                len(attention_mask.shape) == 4 and attention_mask.shape[1] == 1
 
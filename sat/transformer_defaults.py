@@ -26,10 +26,18 @@ def standard_attention(query_layer, key_layer, value_layer, attention_mask,
     if log_attention_weights is not None:
         attention_scores += log_attention_weights
 
-    if not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
-        # if auto-regressive, skip
-        attention_scores = torch.mul(attention_scores, attention_mask) - \
-                           10000.0 * (1.0 - attention_mask)
+    # if auto-regressive (a single all-visible row), skip masking; tensor
+    # values cannot be inspected during CUDA Graph capture, so always mask there
+    if (torch.cuda.is_available() and torch.cuda.is_current_stream_capturing()) \
+            or not (attention_mask.shape[-2] == 1 and (attention_mask > 0).all()):
+        if attention_mask.dtype == torch.bool:
+            # boolean masks materialize the additive form lazily here
+            attention_scores = attention_scores.masked_fill(~attention_mask, -10000.0)
+        else:
+            if attention_mask.dtype != attention_scores.dtype: # if fp16
+                attention_mask = attention_mask.to(attention_scores.dtype)
+            attention_scores = torch.mul(attention_scores, attention_mask) - \
+                               10000.0 * (1.0 - attention_mask)
 
     attention_probs = F.softmax(attention_scores, dim=-1)
 
@@ -52,8 +60,12 @@ def attention_fn_default(query_layer, key_layer, value_layer, attention_mask,
     key_layer = key_layer.unsqueeze(2).expand(-1, -1, num_query_heads//num_kv_heads, -1, -1).contiguous().view(batch_size, num_query_heads, *key_layer.shape[2:])
     value_layer = value_layer.unsqueeze(2).expand(-1, -1, num_query_heads//num_kv_heads, -1, -1).contiguous().view(batch_size, num_query_heads, *value_layer.shape[2:])
 
-    is_low_triangle = (attention_mask == torch.ones_like(attention_mask, dtype=torch.float).tril()).all()
-    is_full = (attention_mask is None) or (attention_mask > 0).all()
+    if torch.cuda.is_available() and torch.cuda.is_current_stream_capturing():
+        # cannot branch on tensor values during CUDA Graph capture
+        is_low_triangle, is_full = False, False
+    else:
+        is_low_triangle = (attention_mask == torch.ones_like(attention_mask, dtype=torch.float).tril()).all()
+        is_full = (attention_mask is None) or (attention_mask > 0).all()
 
     if int(torch.__version__.split('.')[0]) >= 2 and scaling_attention_score and (is_full or is_low_triangle):
         # Pytorch 2.0 attention uses very much memory if attention_mask is float, and has NaN bug if attention_mask is None.